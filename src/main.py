@@ -1,59 +1,91 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # Sample dropblox_ai exectuable.
 #
 
 import json
+import operator
+import random
 import sys
 import time
 
 class InvalidMoveError(ValueError):
   pass
 
-# A class representing an (i, j) position on a board.
-class Point(object):
-  def __init__(self, i=0, j=0):
-    self.i = i
-    self.j = j
-
 # A class representing a Block object.
+#
+# Positions are kept as plain ints rather than objects, since squares() and
+# Board.check are called constantly during the search.
 class Block(object):
   def __init__(self, center, offsets):
     # The block's center and offsets should not be mutated.
-    self.center = Point(center['i'], center['j'])
-    self.offsets = tuple(Point(offset['i'], offset['j']) for offset in offsets)
-    # To move the block, we can change the Point "translation" or increment
+    (self.ci, self.cj) = (center['i'], center['j'])
+    self.off_i = tuple(offset['i'] for offset in offsets)
+    self.off_j = tuple(offset['j'] for offset in offsets)
+    # To move the block, we can change the translation (ti, tj) or increment
     # the value "rotation".
-    self.translation = Point()
+    (self.ti, self.tj) = (0, 0)
     self.rotation = 0
+    # The block only has four distinct orientations, so the rotated offsets
+    # and masks for each are computed up front.
+    self._rotated = [self._rotate_offsets(rotation) for rotation in range(4)]
+    self.rot_masks = [Block._build_masks(offsets) for offsets in self._rotated]
+    self._bottoms = [Block._column_bottoms(offsets) for offsets in self._rotated]
+
+  # Returns the block's offsets from its center, as (di, dj) pairs, after
+  # the given number of rotations.
+  def _rotate_offsets(self, rotation):
+    if rotation % 2:
+      k = 2 - rotation
+      return tuple((k*oj, -k*oi) for (oi, oj) in zip(self.off_i, self.off_j))
+    else:
+      k = 1 - rotation
+      return tuple((k*oi, k*oj) for (oi, oj) in zip(self.off_i, self.off_j))
+
+  # Precomputes the shape of the block for one set of rotated offsets, for use
+  # by Board.check and Board.drop_distance. Returns a tuple
+  #   (min_di, max_di, min_dj, max_dj, masks)
+  # where the first four entries bound the block's offsets from its center,
+  # and masks is a list of (di, mask) pairs, one per occupied row, with bit k
+  # of mask set if the square at column offset min_dj + k is occupied.
+  @staticmethod
+  def _build_masks(offsets):
+    min_dj = min(dj for (di, dj) in offsets)
+    masks = {}
+    for (di, dj) in offsets:
+      masks[di] = masks.get(di, 0) | (1 << (dj - min_dj))
+    return (min(masks), max(masks), min_dj, max(dj for (di, dj) in offsets),
+            sorted(masks.items()))
+
+  # Returns the lowest square of the block in each column it covers, as
+  # (dj, di) pairs. When the block falls, only these squares can land on
+  # anything.
+  @staticmethod
+  def _column_bottoms(offsets):
+    bottoms = {}
+    for (di, dj) in offsets:
+      bottoms[dj] = max(bottoms.get(dj, di), di)
+    return tuple(sorted(bottoms.items()))
 
-  # A generator that returns a list of squares currently occupied by this
+  # A generator that returns the (i, j) squares currently occupied by this
   # block. Takes translations and rotations into account.
   def squares(self):
-    if self.rotation % 2:
-      for offset in self.offsets:
-        yield Point(
-          self.center.i + self.translation.i + (2 - self.rotation)*offset.j,
-          self.center.j + self.translation.j - (2 - self.rotation)*offset.i,
-        )
-    else:
-      for offset in self.offsets:
-        yield Point(
-          self.center.i + self.translation.i + (1 - self.rotation)*offset.i,
-          self.center.j + self.translation.j + (1 - self.rotation)*offset.j,
-        )
+    i = self.ci + self.ti
+    j = self.cj + self.tj
+    for (di, dj) in self._rotated[self.rotation % 4]:
+      yield (i + di, j + dj)
 
   def left(self):
-    self.translation.j -= 1
+    self.tj -= 1
 
   def right(self):
-    self.translation.j += 1
+    self.tj += 1
 
   def up(self):
-    self.translation.i -= 1
+    self.ti -= 1
 
   def down(self):
-    self.translation.i += 1
+    self.ti += 1
 
   def rotate(self):
     self.rotation += 1
@@ -109,43 +141,125 @@ class Block(object):
       self.do_command(command)
 
   def reset_position(self):
-    (self.translation.i, self.translation.j) = (0, 0)
+    (self.ti, self.tj) = (0, 0)
     self.rotation = 0
 
+# The scoring kernels below work directly on a packed bitmap (see Board), so
+# the hot loops only touch local ints and lists.
+
+# Counts any overhang as a hole. This is pessimistic, but should work
+# reasonably well. Each bit of seen is set once its column has been
+# occupied by some row above the current one.
+def _num_holes(bitmap):
+  holes = 0
+  seen = 0
+  for row in bitmap:
+    holes += bin(seen & ~row).count('1')
+    seen |= row
+  return holes
+
+# Returns the list of column heights. The bitmap is walked once from the top,
+# and each column's height is recorded at the first row where its bit shows up.
+def _column_heights(bitmap, rows, cols):
+  heights = cols*[0]
+  seen = 0
+  full = (1 << cols) - 1
+  for row in range(0, rows):
+    new = bitmap[row] & ~seen
+    while new:
+      low = new & -new
+      heights[low.bit_length() - 1] = rows - row
+      new ^= low
+    seen |= bitmap[row]
+    if seen == full:
+      break
+  return heights
+
+def _height_penalty(bitmap, rows):
+  penalty = 0
+  for row in range(0, rows):
+    penalty += (rows - row)*bin(bitmap[row]).count('1')
+  return penalty
+
 # A class representing a board state. Stores the current block and the
 # preview list and handles commands.
+#
+# The bitmap is stored as a list of rows, where each row is packed into a
+# single int: bit j is set if column j of that row is occupied.
+#
+# Each board also carries a Zobrist hash of its bitmap (the XOR of a random
+# key for every occupied square), which is cheap to update as squares are
+# filled in and is used to memoize evaluate().
 class Board(object):
   rows = 33
   cols = 12
+  full_row = (1 << cols) - 1
+  eval_cache = {}
+  remove_rows_cache = {}
 
-  def __init__(self, bitmap, block, preview):
+  def __init__(self, bitmap, block, preview, zhash=None):
     self.bitmap = bitmap
     self.block = block
     self.preview = preview
+    self.zhash = Board.hash_bitmap(bitmap) if zhash is None else zhash
+    self._heights = None
+    self._preview_tail = None
 
   def __repr__(self):
     return str(self)
 
   def __str__(self):
-    return '\n'.join(' '.join('X' if elt else '.' for elt in row) for row in self.bitmap)
+    return '\n'.join(' '.join('X' if (row >> j) & 1 else '.' for j in range(self.cols))
+                     for row in self.bitmap)
 
   @staticmethod
   def construct_from_json(state_json):
     state = json.loads(state_json)
     block = Block(state['block']['center'], state['block']['offsets'])
     preview = [Block(data['center'], data['offsets']) for data in state['preview']]
-    return Board(state['bitmap'], block, preview)
+    bitmap = [sum((1 << j) if elt else 0 for (j, elt) in enumerate(row))
+              for row in state['bitmap']]
+    return Board(bitmap, block, preview)
 
   # Returns True if the block is in valid position - that is, if all of its squares
   # are in bounds and are currently unoccupied.
   def check(self, block):
-    for square in block.squares():
-      if (square.i < 0 or square.i >= self.rows or
-          square.j < 0 or square.j >= self.cols or
-          self.bitmap[square.i][square.j]):
+    (min_di, max_di, min_dj, max_dj, masks) = block.rot_masks[block.rotation % 4]
+    i = block.ci + block.ti
+    j = block.cj + block.tj
+    if i + min_di < 0 or i + max_di >= self.rows or j + min_dj < 0 or j + max_dj >= self.cols:
+      return False
+    bitmap = self.bitmap
+    shift = j + min_dj
+    for (di, mask) in masks:
+      if bitmap[i + di] & (mask << shift):
         return False
     return True
 
+  # Returns how many rows the block can fall before it lands on something.
+  # Assumes the block starts out in valid position.
+  def drop_distance(self, block):
+    rotation = block.rotation % 4
+    i = block.ci + block.ti
+    j = block.cj + block.tj
+    # If every square of the block is above the top of its column, the block
+    # will land on the column tops, and the cached heights tell us where. It's
+    # enough to look at the lowest square in each column.
+    (rows, heights) = (self.rows, self._compute_heights())
+    distance = min(rows - heights[j + dj] - di for (dj, di) in block._bottoms[rotation]) - i - 1
+    if distance >= 0:
+      return distance
+    # Otherwise the block is tucked under an overhang, so scan down row by row.
+    (min_di, max_di, min_dj, max_dj, masks) = block.rot_masks[rotation]
+    shift = j + min_dj
+    masks = [(i + di, mask << shift) for (di, mask) in masks]
+    bitmap = self.bitmap
+    for distance in range(1, rows - i - max_di):
+      for (row, mask) in masks:
+        if bitmap[row + distance] & mask:
+          return distance - 1
+    return rows - 1 - i - max_di
+
   # Handles a list of commands to move the current block, and drops it at the end.
   # Appends a 'drop' command to the list if it does not appear, and returns the
   # new Board state object.
@@ -166,6 +280,15 @@ class Board(object):
         if not self.check(self.block):
           raise InvalidMoveError()
 
+  # Moves the current block straight to the given rotation and column translation,
+  # then places it. Returns the new Board state object.
+  #
+  # Unlike do_commands, this doesn't check that the block can actually get there;
+  # the caller is responsible for only asking for reachable positions.
+  def drop_at(self, rotation, tj):
+    (self.block.ti, self.block.tj, self.block.rotation) = (0, tj, rotation)
+    return self.place()
+
   # Drops the current block as far as it can fall unobstructed, then locks it onto the
   # board. Returns a new board with the next block drawn from the preview list.
   #
@@ -174,86 +297,117 @@ class Board(object):
   # If there are no blocks left in the preview list, this method will fail badly!
   # This is okay because we don't expect to look ahead that far.
   def place(self):
-    while self.check(self.block):
-      self.block.down()
-    self.block.up()
-    # Deep-copy the bitmap to avoid changing this board's state.
-    new_bitmap = [list(row) for row in self.bitmap]
-    for square in self.block.squares():
-      new_bitmap[square.i][square.j] = 1
-    new_bitmap = Board.remove_rows(new_bitmap)
+    block = self.block
+    block.ti += self.drop_distance(block)
+    # Copy the bitmap to avoid changing this board's state. Rows are ints, so a
+    # shallow copy is enough.
+    new_bitmap = self.bitmap[:]
+    zhash = self.zhash
+    (min_di, max_di, min_dj, max_dj, masks) = block.rot_masks[block.rotation % 4]
+    i = block.ci + block.ti
+    shift = block.cj + block.tj + min_dj
+    for (di, mask) in masks:
+      new_bitmap[i + di] |= mask << shift
+      zhash ^= Board.hash_row(i + di, mask << shift)
+    cleared_bitmap = Board.remove_rows(new_bitmap)
+    if cleared_bitmap is not new_bitmap:
+      # Clearing rows shifts everything above them, so just start over.
+      zhash = None
     if len(self.preview) == 0:
-      print "There are no blocks left in the preview list! You can't look that far ahead."
+      print("There are no blocks left in the preview list! You can't look that far ahead.")
       return None
-    return Board(new_bitmap, self.preview[0], self.preview[1:])
+    # Every placement from this board shares the same remaining preview list, so
+    # only slice it once.
+    if self._preview_tail is None:
+      self._preview_tail = self.preview[1:]
+    return Board(cleared_bitmap, self.preview[0], self._preview_tail, zhash)
 
-  # A helper method used to remove any full rows from a bitmap. Returns the new bitmap.
+  # Computes the Zobrist hash of a bitmap from scratch.
+  @staticmethod
+  def hash_bitmap(bitmap):
+    zhash = 0
+    for (i, row) in enumerate(bitmap):
+      if row:
+        zhash ^= Board.hash_row(i, row)
+    return zhash
+
+  # Returns the XOR of the Zobrist keys for the squares set in row i.
+  @staticmethod
+  def hash_row(i, row):
+    keys = Board.zobrist[i]
+    zhash = 0
+    while row:
+      low = row & -row
+      zhash ^= keys[low.bit_length() - 1]
+      row ^= low
+    return zhash
+
+  # A helper method used to remove any full rows from a bitmap. Returns the new bitmap,
+  # or the same bitmap object if there were no full rows.
+  #
+  # Results are memoized, since different placements that complete the same rows
+  # often leave identical bitmaps. The returned bitmap may be shared, so it must
+  # not be modified in place.
   @staticmethod
   def remove_rows(bitmap):
-    (rows, cols) = (len(bitmap), len(bitmap[0]))
-    new_bitmap = [row for row in bitmap if not all(row)]
-    return [cols*[0] for i in range(rows - len(new_bitmap))] + new_bitmap
+    full_row = Board.full_row
+    # Most placements don't clear anything, and this is a single C-level scan.
+    if full_row not in bitmap:
+      return bitmap
+    key = tuple(bitmap)
+    new_bitmap = Board.remove_rows_cache.get(key)
+    if new_bitmap is None:
+      kept = [row for row in bitmap if row != full_row]
+      new_bitmap = [0]*(len(bitmap) - len(kept)) + kept
+      Board.remove_rows_cache[key] = new_bitmap
+    return new_bitmap
 
   def size(self):
-    return (len(self.bitmap), len(self.bitmap[0]))
+    return (len(self.bitmap), self.cols)
 
   def num_holes(self):
-    (rows, cols) = self.size()
-    holes = 0
-    # Counts any overhang as a hole. This is pessimistic, but should work
-    # reasonably well.
-    column_occupied = cols*[0]
-    for row in range(0, rows):
-      for col in range(0, cols):
-        if self.bitmap[row][col] == 0:
-          if column_occupied[col]:
-            holes += 1
-        else:
-          column_occupied[col] += 1
-    return holes
+    return _num_holes(self.bitmap)
+
+  # Returns the list of column heights, computing it on first use.
+  def _compute_heights(self):
+    if self._heights is None:
+      self._heights = _column_heights(self.bitmap, self.rows, self.cols)
+    return self._heights
 
   def col_height(self, col):
-    (rows, _) = self.size()
-    for row in range(0, rows):
-      if self.bitmap[row][col] != 0:
-        return rows - row
-    return 0
+    return self._compute_heights()[col]
 
   def max_height(self):
-    (rows, cols) = self.size()
-    m_height = 0
-    for col in range(0, cols):
-      m_height = max(m_height, self.col_height(col))
-    return m_height
+    return max(self._compute_heights())
 
+  # Sums the height differences between neighbouring columns.
   def height_variance(self):
-    (rows, cols) = self.size()
-    variance = 0
-    prev = self.col_height(0)
-    for col in range(0, cols):
-      cur = self.col_height(col)
-      variance += abs(cur - prev)
-      prev = cur
-    return variance
+    heights = self._compute_heights()
+    return sum(map(abs, map(operator.sub, heights[1:], heights[:-1])))
 
+  # Not currently used by evaluate().
   def height_penalty(self):
-    (rows, cols) = self.size()
-    penalty = 0
-    for row in range(0, rows):
-      for col in range(0, cols):
-        if self.bitmap[row][col] != 0:
-          penalty += rows - row
-    return penalty
+    return _height_penalty(self.bitmap, self.rows)
 
+  # Scores are memoized by Zobrist hash, since different move sequences
+  # often lock the block into the same final position.
   def evaluate(self):
-    return -self.num_holes() - self.max_height() \
-      - self.height_variance()# - self.height_penalty()
-
-test_board = Board([[1, 1, 1], [1, 0, 1], [1, 1, 1]], None, None)
-print test_board.num_holes()
-print test_board.max_height()
-print test_board.height_variance()
-print test_board.height_penalty()
+    score = Board.eval_cache.get(self.zhash)
+    if score is None:
+      score = -self.num_holes() - self.max_height() \
+        - self.height_variance()# - self.height_penalty()
+      Board.eval_cache[self.zhash] = score
+    return score
+
+# Random keys for each square, used to compute Zobrist hashes.
+Board.zobrist = [[random.getrandbits(64) for j in range(Board.cols)]
+                 for i in range(Board.rows)]
+
+test_board = Board((Board.rows - 3)*[0] + [0b111, 0b101, 0b111], None, None)
+print(test_board.num_holes())
+print(test_board.max_height())
+print(test_board.height_variance())
+print(test_board.height_penalty())
 
 if __name__ == '__main__':
   if len(sys.argv) == 3:
@@ -267,27 +421,37 @@ if __name__ == '__main__':
     # current block
     block = board.block
 
-    best = -sys.maxint - 1
-    choices = {}
-    for i in range(0, 12):
-      moves = []
+    # Try every final (rotation, column) placement. The block is rotated at the
+    # top of the board and then slid sideways before dropping, so for each
+    # rotation we only need to find how far left and right it can go.
+    best = -sys.maxsize - 1
+    best_choice = None
+    for rotation in range(0, 4):
+      block.reset_position()
+      block.rotation = rotation
+      if not board.check(block):
+        # Every further rotation has to pass through this one.
+        break
       while block.checked_left(board):
-        moves.append('left')
-      for _ in range(0, i):
-        moves.append('right')
-      while block.checked_down(board):
-        moves.append('down')
-
-      for _ in xrange(0, 3):
-        moves.append('rotate')
-        block.reset_position()
-        try:
-          new_board = board.do_commands(moves[:])
-          cur = new_board.evaluate()
-          choices[cur] = moves[:]
-        except InvalidMoveError as e:
-          continue
-
-    todo = choices[max(choices)]
-    print '\n'.join(todo)
+        pass
+      leftmost = block.tj
+      block.tj = 0
+      while block.checked_right(board):
+        pass
+      rightmost = block.tj
+
+      for tj in range(leftmost, rightmost + 1):
+        cur = board.drop_at(rotation, tj).evaluate()
+        # Ties go to the last placement tried, as they did when the choices
+        # were kept in a dict keyed by score.
+        if cur >= best:
+          (best, best_choice) = (cur, (rotation, tj))
+
+    if best_choice is not None:
+      # Only build the command list for the winning placement.
+      (rotation, tj) = best_choice
+      todo = rotation*['rotate'] + (-tj*['left'] if tj < 0 else tj*['right'])
+      if todo:
+        # An empty list would print a blank line, which the client rejects.
+        print('\n'.join(todo))
     sys.stdout.flush()